@@ -1,56 +1,90 @@
-from flask import Flask, request
-import json
+from flask import Flask, Response, request
+import orjson
+import os
 import psutil
 import threading
 import time
 from datetime import datetime
-from queue import Queue
+from queue import SimpleQueue, Empty
+from waitress import serve
 import esp_mb_api
 
 app = Flask(__name__)
 
-# Глобальные переменные для хранения системных данных
-system_data = {
-    "cpu_percent": 0,
-    "memory_percent": 0,
-    "memory_used_gb": 0,
-    "memory_total_gb": 0,
-    "swap_percent": 0,
-    "swap_used_gb": 0,
-    "cpu_temp": 0,
-    "last_update": ""
-}
+# Шаблон ответа с системными данными (набор и порядок полей фиксированы).
+# %a даёт repr числа, что совпадает с записью числа в JSON
+SYSTEM_DATA_TEMPLATE = (
+    b'{"cpu_percent":%a,"memory_percent":%a,"memory_used_gb":%a,'
+    b'"memory_total_gb":%a,"swap_percent":%a,"swap_used_gb":%a,'
+    b'"cpu_temp":%a,"last_update":"%s"}'
+)
+
+# Готовый ответ с системными данными, обновляется фоновым потоком
+system_data_bytes = SYSTEM_DATA_TEMPLATE % (0, 0, 0, 0, 0, 0, 0, b"")
 
 # Глобальные переменные для Modbus данных
-modbus_data = {
-    "chanel_0": 0,
-    "chanel_1": 0,
-    "chanel_2": 0,
-    "chanel_3": 0,
-    "chanel_4": 0,
-    "chanel_5": 0,
-    "chanel_6": 0,
-    "chanel_7": 0,
-    "chanel_8": 0,
-    "chanel_9": 0,
-    "chanel_10": 0,
-    "chanel_11": 0,
-    "chanel_12": 0,
-    "chanel_13": 0,
-    "chanel_14": 0,
-    "chanel_15": 0,
-}
+CHANEL_KEYS = tuple(f"chanel_{i}" for i in range(16))
+modbus_values = (0,) * 16
+
+# Сериализованные значения каналов, обновляются только при их изменении
+modbus_data_bytes = orjson.dumps(dict(zip(CHANEL_KEYS, modbus_values)))
 
 # Очередь для команд записи в каналы
-write_queue = Queue()
+write_queue = SimpleQueue()
+
+# Период чтения данных из Modbus (секунды)
+MODBUS_READ_INTERVAL = 0.05
+
+# Период обновления системных данных (секунды)
+SYSTEM_UPDATE_INTERVAL = 0.33
 
-# Блокировка для безопасного доступа к modbus_data
-modbus_lock = threading.Lock()
+# Найденный источник температуры CPU: (имя сенсора psutil, индекс)
+# или открытый дескриптор файла thermal_zone
+THERMAL_ZONE_PATH = '/sys/class/thermal/thermal_zone0/temp'
+temp_sensor = None
+temp_fd = None
+
+
+def json_response(data):
+    """Ответ с JSON (сериализация через orjson)"""
+    return Response(orjson.dumps(data), mimetype='application/json')
+
+
+def open_thermal_zone():
+    """Открыть THERMAL_ZONE_PATH и сохранить дескриптор в temp_fd; вернуть температуру или None"""
+    global temp_fd
+    try:
+        fd = os.open(THERMAL_ZONE_PATH, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        temp = float(os.pread(fd, 16, 0)) / 1000
+    except (OSError, ValueError):
+        os.close(fd)
+        return None
+    temp_fd = fd
+    return round(temp, 1)
 
 
 def get_cpu_temperature():
     """Получение температуры процессора"""
+    global temp_sensor, temp_fd
     try:
+        # Источник уже найден при предыдущих вызовах
+        if temp_fd is not None:
+            try:
+                return round(float(os.pread(temp_fd, 16, 0)) / 1000, 1)
+            except (OSError, ValueError):
+                os.close(temp_fd)
+                temp_fd = None
+        
+        if temp_sensor is not None:
+            try:
+                name, index = temp_sensor
+                return round(psutil.sensors_temperatures()[name][index].current, 1)
+            except (KeyError, IndexError):
+                temp_sensor = None
+        
         # Для Linux систем
         if hasattr(psutil, "sensors_temperatures"):
             temps = psutil.sensors_temperatures()
@@ -59,20 +93,25 @@ def get_cpu_temperature():
                 for name, entries in temps.items():
                     if name in ['coretemp', 'k10temp', 'cpu_thermal']:
                         if entries:
+                            # На Raspberry Pi cpu_thermal - это thermal_zone0:
+                            # дальше читаем файл напрямую, без обхода всех сенсоров psutil
+                            if name == 'cpu_thermal':
+                                temp = open_thermal_zone()
+                                if temp is not None:
+                                    return temp
+                            temp_sensor = (name, 0)
                             return round(entries[0].current, 1)
                 
                 # Если специфические не найдены, берем первый доступный
                 for name, entries in temps.items():
                     if entries:
+                        temp_sensor = (name, 0)
                         return round(entries[0].current, 1)
         
-        # Альтернативный метод для Raspberry Pi
-        try:
-            with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-                temp = float(f.read().strip()) / 1000
-                return round(temp, 1)
-        except:
-            pass
+        # Альтернативный метод для Raspberry Pi (файл остаётся открытым)
+        temp = open_thermal_zone()
+        if temp is not None:
+            return temp
         
         return 0  # Если температуру получить не удалось
     except Exception as e:
@@ -82,11 +121,16 @@ def get_cpu_temperature():
 
 def update_system_data():
     """Обновление системных данных в отдельном потоке"""
-    global system_data
+    global system_data_bytes
+    
+    # Первый вызов только запоминает счётчики CPU, дальше - разница между вызовами
+    psutil.cpu_percent(interval=None)
+    next_update = time.perf_counter()
+    
     while True:
         try:
-            # Получаем данные о процессоре
-            cpu_percent = psutil.cpu_percent(interval=0.1)
+            # Получаем данные о процессоре (без блокирующего ожидания)
+            cpu_percent = psutil.cpu_percent(interval=None)
             
             # Получаем данные о памяти
             memory = psutil.virtual_memory()
@@ -102,70 +146,116 @@ def update_system_data():
             # Получаем температуру процессора
             cpu_temp = get_cpu_temperature()
             
-            # Обновляем глобальные данные
-            system_data.update({
-                "cpu_percent": round(cpu_percent, 1),
-                "memory_percent": round(memory_percent, 1),
-                "memory_used_gb": memory_used_gb,
-                "memory_total_gb": memory_total_gb,
-                "swap_percent": round(swap_percent, 1),
-                "swap_used_gb": swap_used_gb,
-                "cpu_temp": cpu_temp,
-                "last_update": datetime.now().strftime("%H:%M:%S")
-            })
+            # Обновляем готовый ответ
+            system_data_bytes = SYSTEM_DATA_TEMPLATE % (
+                round(cpu_percent, 1),
+                round(memory_percent, 1),
+                memory_used_gb,
+                memory_total_gb,
+                round(swap_percent, 1),
+                swap_used_gb,
+                cpu_temp,
+                datetime.now().strftime("%H:%M:%S").encode()
+            )
         except Exception as e:
             print(f"Ошибка обновления системных данных: {e}")
         
-        # Обновляем данные 3 раза в секунду
-        time.sleep(0.33)
+        # Обновляем данные 3 раза в секунду, период отсчитываем от дедлайна
+        next_update = max(next_update + SYSTEM_UPDATE_INTERVAL, time.perf_counter())
+        time.sleep(max(next_update - time.perf_counter(), 0))
+
+
+def split_chanel_runs(pending):
+    """Разбить команды записи на диапазоны подряд идущих каналов"""
+    runs = []
+    for chanel in sorted(pending):
+        if runs and chanel == runs[-1][0] + len(runs[-1][1]):
+            runs[-1][1].append(pending[chanel])
+        else:
+            runs.append((chanel, [pending[chanel]]))
+    return runs
+
+
+def write_chanel_run(start, values):
+    """Запись диапазона подряд идущих каналов одним запросом (функция 0x10)"""
+    try:
+        esp_mb_api.write_chanels(start, values)
+    except Exception as e:
+        print(f"Ошибка записи в каналы {start}-{start + len(values) - 1}: {e}")
+
+
+def store_modbus_data(raw_data):
+    """Сохранить прочитанные значения каналов"""
+    global modbus_values, modbus_data_bytes
+    values = tuple(raw_data)
+    if values == modbus_values:
+        # Данные не изменились - готовый ответ остаётся актуальным
+        return
+    modbus_values = values
+    # Публикация одним присваиванием (атомарно под GIL), читателям блокировка не нужна
+    modbus_data_bytes = orjson.dumps(dict(zip(CHANEL_KEYS, values)))
 
 
 def update_modbus_data():
     """Фоновое обновление данных из Modbus и обработка команд записи"""
-    global modbus_data
+    next_read = time.perf_counter()
     
     while True:
         try:
-            # Обработка команд из очереди (без блокировок)
-            if not write_queue.empty():
+            # Ждём команду записи не дольше, чем до следующего чтения
+            timeout = max(next_read - time.perf_counter(), 0)
+            try:
+                chanel, data = write_queue.get(timeout=timeout)
+            except Empty:
+                pass
+            else:
+                # Забираем все накопившиеся команды, для канала важна последняя
+                pending = {chanel: data}
+                while True:
+                    try:
+                        chanel, data = write_queue.get_nowait()
+                    except Empty:
+                        break
+                    pending[chanel] = data
+                runs = split_chanel_runs(pending)
+                for start, values in runs[:-1]:
+                    write_chanel_run(start, values)
+                
+                # Последний диапазон пишем вместе с чтением всех каналов (0x17)
+                start, values = runs[-1]
                 try:
-                    chanel, data = write_queue.get_nowait()
-                    esp_mb_api.write_chanel(chanel, data)
-                except:
-                    pass
+                    store_modbus_data(esp_mb_api.write_chanels_read_data(start, values))
+                    next_read = time.perf_counter() + MODBUS_READ_INTERVAL
+                except Exception as e:
+                    print(f"Ошибка записи/чтения Modbus данных: {e}")
+                continue
+            
+            # Следующее чтение планируем от дедлайна, а не от конца sleep
+            next_read = max(next_read + MODBUS_READ_INTERVAL, time.perf_counter())
             
             # Чтение данных из Modbus
             try:
-                raw_data = esp_mb_api.read_data()
-                
-                # Обновляем глобальные данные с блокировкой
-                with modbus_lock:
-                    for i, value in enumerate(raw_data):
-                        modbus_data[f"chanel_{i}"] = value
+                store_modbus_data(esp_mb_api.read_data())
             except Exception as e:
                 print(f"Ошибка чтения Modbus данных: {e}")
-            
-            # Небольшая пауза для разгрузки CPU
-            time.sleep(0.05)
         
         except Exception as e:
             print(f"Ошибка в потоке обновления Modbus: {e}")
             time.sleep(0.1)
+            next_read = time.perf_counter()
 
 
 @app.route('/')
 def api_data():
     """API эндпоинт для получения системных данных"""
-    global system_data
-    return json.dumps(system_data)
+    return Response(system_data_bytes, mimetype='application/json')
 
 
 @app.route('/get_chanel', methods=['GET'])
 def get_chanel():
     """API эндпоинт для получения значений всех каналов"""
-    with modbus_lock:
-        # Возвращаем копию данных для избежания проблем с многопоточностью
-        return json.dumps(modbus_data.copy())
+    # Готовые байты, сериализация выполнена при обновлении данных
+    return Response(modbus_data_bytes, mimetype='application/json')
 
 
 @app.route('/set_chanel', methods=['POST'])
@@ -176,7 +266,7 @@ def set_chanel():
         
         # Валидация входных данных
         if not request_data or 'chanel' not in request_data or 'data' not in request_data:
-            return json.dumps({
+            return json_response({
                 "status": "error",
                 "message": "Missing 'chanel' or 'data' field"
             }), 400
@@ -186,13 +276,13 @@ def set_chanel():
         
         # Проверка диапазонов
         if chanel < 0 or chanel > 15:
-            return json.dumps({
+            return json_response({
                 "status": "error",
                 "message": "Channel must be between 0 and 15"
             }), 400
         
         if data < -100 or data > 100:
-            return json.dumps({
+            return json_response({
                 "status": "error",
                 "message": "Data must be between -100 and 100"
             }), 400
@@ -200,7 +290,7 @@ def set_chanel():
         # Добавляем команду в очередь (это не блокирует запрос)
         write_queue.put((chanel, data))
         
-        return json.dumps({
+        return json_response({
             "status": "success",
             "message": f"Channel {chanel} write request queued",
             "chanel": chanel,
@@ -208,12 +298,12 @@ def set_chanel():
         }), 200
     
     except ValueError:
-        return json.dumps({
+        return json_response({
             "status": "error",
             "message": "Invalid data type. 'chanel' and 'data' must be integers"
         }), 400
     except Exception as e:
-        return json.dumps({
+        return json_response({
             "status": "error",
             "message": str(e)
         }), 500
@@ -225,13 +315,13 @@ def set_chanel_url(chanel, data):
     try:
         # Проверка диапазонов
         if chanel < 0 or chanel > 15:
-            return json.dumps({
+            return json_response({
                 "status": "error",
                 "message": "Channel must be between 0 and 15"
             }), 400
         
         if data < -100 or data > 100:
-            return json.dumps({
+            return json_response({
                 "status": "error",
                 "message": "Data must be between -100 and 100"
             }), 400
@@ -239,7 +329,7 @@ def set_chanel_url(chanel, data):
         # Добавляем команду в очередь
         write_queue.put((chanel, data))
         
-        return json.dumps({
+        return json_response({
             "status": "success",
             "message": f"Channel {chanel} write request queued",
             "chanel": chanel,
@@ -247,7 +337,7 @@ def set_chanel_url(chanel, data):
         }), 200
     
     except Exception as e:
-        return json.dumps({
+        return json_response({
             "status": "error",
             "message": str(e)
         }), 500
@@ -262,5 +352,6 @@ if __name__ == '__main__':
     modbus_thread = threading.Thread(target=update_modbus_data, daemon=True)
     modbus_thread.start()
     
-    # Запускаем Flask приложение
-    app.run(host='localhost', port=8081, debug=False)
\ No newline at end of file
+    # Запускаем Flask приложение на WSGI сервере waitress (пул потоков
+    # вместо dev-сервера Werkzeug). Процесс один - порт Modbus не делится
+    serve(app, host='localhost', port=8081, threads=8)
\ No newline at end of file
@@ -1,76 +1,145 @@
-import minimalmodbus
 import serial
+import struct
 import time
+import modbus_rtu
 
-instrument = minimalmodbus.Instrument('/dev/serial/by-path/platform-3f980000.usb-usbv2-0:1.1.2:1.0-port0', 0x01, close_port_after_each_call=False)
-instrument.serial.bytesize = 8
-instrument.serial.parity   = serial.PARITY_NONE
-instrument.serial.stopbits = serial.STOPBITS_ONE
-instrument.serial.baudrate = 115200
+PORT = '/dev/serial/by-path/platform-3f980000.usb-usbv2-0:1.1.2:1.0-port0'
+SLAVE_ADDRESS = 0x01
+BAUDRATE = 115200
+TIMEOUT = 0.05
+INTER_BYTE_TIMEOUT = 0.005
 
+port = serial.Serial(PORT, BAUDRATE,
+                     bytesize=serial.EIGHTBITS,
+                     parity=serial.PARITY_NONE,
+                     stopbits=serial.STOPBITS_ONE,
+                     timeout=TIMEOUT,
+                     inter_byte_timeout=INTER_BYTE_TIMEOUT)
 
-def unsigned_to_signed_16bit(val):
-    if val >= 2**15:
-        val -= 2**16
-    return val
+# Запрос чтения всех 16 каналов не меняется - собираем его один раз
+READ_DATA_REQUEST = modbus_rtu.create_modbus_read_request(SLAVE_ADDRESS, 0, 16)
+
+# Код исключения Modbus "Illegal Function"
+ILLEGAL_FUNCTION = 0x01
+
+# Повторы при ошибках обмена: число попыток и пауза (удваивается с каждой попыткой)
+MAX_RETRIES = 5
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 1.0
+
+# Поддерживает ли устройство функцию 0x17 (Read/Write Multiple Registers)
+read_write_supported = True
+
+
+class IllegalFunctionError(Exception):
+    """Устройство не поддерживает функцию Modbus"""
+
+
+def registers_to_signed(registers):
+    """Перевод регистров uint16 в int16 одним вызовом struct"""
+    count = len(registers)
+    return list(struct.unpack(f'{count}h', struct.pack(f'{count}H', *registers)))
 
 
 def signed_to_unsigned_16bit(val):
-    if val < 0:
-        val += 2**16
-    return val
+    return val & 0xFFFF
 
 def write_chanel(chanel, data = -100):
-    if data >= 100:
-        data = 100
-    elif data <= -100:
-        data = -100
-    if chanel > 15:
-        raise Exception("chanel max = 15")
-    if chanel < 0:
+    """Запись одного канала (функция 0x10 с одним регистром)"""
+    write_chanels(chanel, [data])
+
+
+def _prepare_chanel_values(start_chanel, data_list):
+    """Проверка диапазона каналов и перевод значений в регистры"""
+    if start_chanel < 0:
         raise Exception("chanel min = 0")
-    data = signed_to_unsigned_16bit(data)
-    while True:
+    if start_chanel + len(data_list) - 1 > 15:
+        raise Exception("chanel max = 15")
+    values = []
+    for data in data_list:
+        if data >= 100:
+            data = 100
+        elif data <= -100:
+            data = -100
+        values.append(signed_to_unsigned_16bit(data))
+    return values
+
+
+def _reopen_port():
+    """Переоткрыть последовательный порт"""
+    try:
+        port.close()
+        port.open()
+    except Exception as e:
+        print(e)
+
+
+def _transaction(request):
+    """Обмен одним кадром с устройством, ответ с ошибкой - исключение"""
+    response = modbus_rtu.send_modbus_request(port, request)
+    parsed = modbus_rtu.parse_modbus_response(response)
+    if parsed['status'] != 'success':
+        if parsed.get('exception_code') == ILLEGAL_FUNCTION:
+            raise IllegalFunctionError(f"Slave reported illegal function: {parsed['raw']}")
+        raise Exception(f"Modbus error response: {parsed.get('message', parsed['raw'])}")
+    if parsed['slave_address'] != request[0]:
+        raise Exception(f"Wrong slave address in response: {parsed['raw']}")
+    if parsed['function_code'] != request[1]:
+        raise Exception(f"Wrong function code in response: {parsed['raw']}")
+    # 0x10 возвращает начальный адрес и число записанных регистров из запроса
+    if request[1] == 0x10 and response[2:6] != request[2:6]:
+        raise Exception(f"Wrong write echo in response: {parsed['raw']}")
+    return parsed
+
+
+def _call_with_reconnect(request):
+    """Запрос к устройству с ограниченным числом повторов и растущей паузой"""
+    for attempt in range(MAX_RETRIES):
         try:
-            instrument.write_register(chanel, data)
-            break
-        except serial.SerialException as e:
-            print(e)
-            while True:
-                time.sleep(0.1)
-                try:
-                    instrument.serial.close()
-                    instrument.serial.open()
-                    break
-                except Exception as e:
-                    print(e)
-                    pass
+            return _transaction(request)
+        except IllegalFunctionError:
+            raise
         except Exception as e:
             print(e)
-            pass
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY))
+            if isinstance(e, serial.SerialException):
+                _reopen_port()
 
 
+def _read_chanels(parsed):
+    """Значения 16 каналов из ответа устройства"""
+    data = parsed['registers']
+    if len(data) != 16:
+        raise Exception(f"Wrong registers count in response: {parsed['raw']}")
+    return registers_to_signed(data)
 
-def read_data():
-    while True:
+
+def write_chanels(start_chanel, data_list):
+    """Запись подряд идущих каналов одним запросом (функция 0x10)"""
+    values = _prepare_chanel_values(start_chanel, data_list)
+    _call_with_reconnect(modbus_rtu.create_modbus_write_multiple_request(SLAVE_ADDRESS, start_chanel, values))
+
+
+def write_chanels_read_data(start_chanel, data_list):
+    """Запись каналов и чтение всех 16 каналов за одну транзакцию (функция 0x17)"""
+    global read_write_supported
+    values = _prepare_chanel_values(start_chanel, data_list)
+    if read_write_supported:
         try:
-            data = instrument.read_registers(0, 16)
-            break
-        except serial.SerialException as e:
-            print(e)
-            while True:
-                time.sleep(0.1)
-                try:
-                    instrument.serial.close()
-                    instrument.serial.open()
-                    break
-                except Exception as e:
-                    print(e)
-        except Exception as e:
+            request = modbus_rtu.create_modbus_read_write_request(SLAVE_ADDRESS, 0, 16, start_chanel, values)
+            return _read_chanels(_call_with_reconnect(request))
+        except IllegalFunctionError as e:
+            # Устройство не поддерживает функцию 0x17 - пишем и читаем раздельно
             print(e)
-    for i in range(len(data)):
-        data[i] = unsigned_to_signed_16bit(data[i])
-    return data
+            read_write_supported = False
+    _call_with_reconnect(modbus_rtu.create_modbus_write_multiple_request(SLAVE_ADDRESS, start_chanel, values))
+    return read_data()
+
+
+def read_data():
+    return _read_chanels(_call_with_reconnect(READ_DATA_REQUEST))
 
 if __name__ == "__main__":
     while True:
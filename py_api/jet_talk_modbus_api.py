@@ -1,11 +1,20 @@
+import heapq
+import orjson
 import serial
-import struct
 import time
 import threading
+from array import array
 from collections import deque
 from flask import Flask, jsonify, request
-from datetime import datetime
-from queue import Queue, Empty
+from queue import SimpleQueue, Empty
+from waitress import serve
+from modbus_rtu import (
+    create_modbus_read_request,
+    create_modbus_write_request,
+    create_modbus_write_multiple_request,
+    parse_modbus_response,
+    send_modbus_request,
+)
 
 app = Flask(__name__)
 
@@ -14,31 +23,64 @@ PORT = '/dev/ttyACM0'
 BAUDRATE = 115200
 SLAVE_ADDRESS = 5
 MAX_READ_QUANTITY = 47
-TIMEOUT = 1.0
+MAX_WRITE_QUANTITY = 123  # Лимит регистров в одном кадре 0x10
+WRITE_BURST_SIZE = 32  # Сколько задач записи забирать из очереди за один проход
+TIMEOUT = 0.05  # Ожидание ответа: самый длинный кадр 0x03 (47 регистров) на 115200 идёт ~9 мс
+INTER_BYTE_TIMEOUT = 0.005  # Пауза внутри кадра, после которой кадр считается оборванным
 LOGS_ENABLED = 1
 MAX_ERROR_LOGS = 30
 POLLING_INTERVAL = 0.1  # Задержка между запросами к железу (секунды)
+TASK_WAIT_SLICE = 0.005  # Шаг проверки очереди во время пауз polling (секунды)
 RANGE_TIMEOUT = 10  # Таймаут неиспользуемого диапазона (секунды)
+RANGE_MERGE_GAP = 16  # Диапазоны с промежутком до N регистров читаются одним блоком
+REQUEST_CACHE_SIZE = 256  # Максимум закэшированных кадров чтения
+REGISTER_SPACE = 65536  # Размер адресного пространства регистров Modbus
+ILLEGAL_FUNCTION = 0x01  # Код исключения Modbus "Illegal Function"
+
+# ===== TIMESTAMPS =====
+_timestamp_cache = (0, '')  # (секунда, отформатированная строка)
+
+def _now_str():
+    """Current time as 'YYYY-mm-dd HH:MM:SS', formatted at most once per second"""
+    global _timestamp_cache
+    now = int(time.time())
+    second, text = _timestamp_cache
+    if second != now:
+        text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+        _timestamp_cache = (now, text)
+    return text
 
 # ===== GLOBAL STATE =====
 class ModbusClient:
     def __init__(self):
-        self.port = None
+        self.port = None  # Порт использует только фоновый поток
+        self.connected = False  # Меняет только фоновый поток при open/close
         self.status = 'offline'
         self.last_packets = deque(maxlen=10)
+        self.last_packets_sum = 0.0  # Сумма last_packets для O(1) среднего
         self.error_logs = deque(maxlen=MAX_ERROR_LOGS)
-        self.lock = threading.Lock()
+        self.error_logs_snapshot = ()  # Копия error_logs для /status, обновляется при записи
+        
+        # Кэш готовых кадров чтения {(slave, address, quantity): request}
+        self.request_cache = {}
         
         # Кэш данных регистров
-        self.register_cache = {}  # {address: value}
+        self.register_cache = array('H', bytes(2 * REGISTER_SPACE))  # значение по адресу
+        self.cached_mask = bytearray(REGISTER_SPACE)  # 1 - адрес уже прочитан
+        self.cached_count = 0
         self.cache_lock = threading.Lock()
         
         # Диапазоны для polling
         self.active_ranges = {}  # {(start, end): last_access_time}
+        self.ranges_heap = []  # [(last_access_time, (start, end))], по одной записи на диапазон
+        self.polling_ranges = []  # [(start, end)] - active_ranges, объединённые для polling
         self.ranges_lock = threading.Lock()
         
         # Очередь задач
-        self.task_queue = Queue()
+        self.task_queue = SimpleQueue()
+        
+        # Поддерживает ли устройство функцию 0x10 (Write Multiple Registers)
+        self.write_multiple_supported = True
         
         # Флаг работы фонового потока
         self.running = False
@@ -49,40 +91,45 @@ class ModbusClient:
         if not LOGS_ENABLED:
             return
         
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = _now_str()
         log_msg = f"[{timestamp}] [{level}] {message}"
         print(log_msg)
     
     def add_error_log(self, message):
         """Add error to log buffer"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = _now_str()
         error_msg = f"[{timestamp}] {message}"
         self.error_logs.append(error_msg)
+        self.error_logs_snapshot = tuple(self.error_logs)
         self.log(f"ERROR: {message}", 'ERROR')
     
     def record_packet_time(self, response_time):
         """Record response time for average calculation"""
+        if len(self.last_packets) == self.last_packets.maxlen:
+            self.last_packets_sum -= self.last_packets[0]
         self.last_packets.append(response_time)
+        self.last_packets_sum += response_time
     
     def get_avg_response_time(self):
         """Get average response time from last 10 packets"""
-        if not self.last_packets:
+        count = len(self.last_packets)
+        if not count:
             return 0
-        return sum(self.last_packets) / len(self.last_packets)
+        return self.last_packets_sum / count
     
     def is_connected(self):
         """Check if port is open and working"""
-        if self.port is None or not self.port.is_open:
-            return False
-        return True
+        return self.connected
     
     def open_port(self):
         """Try to open serial port"""
         try:
             if self.port and self.port.is_open:
                 self.port.close()
+            self.connected = False
             
-            self.port = serial.Serial(PORT, BAUDRATE, timeout=TIMEOUT)
+            self.port = serial.Serial(PORT, BAUDRATE, timeout=TIMEOUT, inter_byte_timeout=INTER_BYTE_TIMEOUT)
+            self.connected = True
             self.status = 'online'
             self.log(f"Serial port opened: {PORT} @ {BAUDRATE} baud")
             return True
@@ -93,6 +140,7 @@ class ModbusClient:
     
     def close_port(self):
         """Close serial port"""
+        self.connected = False
         try:
             if self.port and self.port.is_open:
                 self.port.close()
@@ -102,177 +150,220 @@ class ModbusClient:
     
     def update_active_range(self, start, end):
         """Обновить активный диапазон"""
+        last_access = time.time()
         with self.ranges_lock:
-            self.active_ranges[(start, end)] = time.time()
+            is_new = (start, end) not in self.active_ranges
+            self.active_ranges[(start, end)] = last_access
+            
+            # Куча и пересчёт нужны только при появлении нового диапазона;
+            # время в куче обновляется лениво в get_polling_ranges
+            if is_new:
+                heapq.heappush(self.ranges_heap, (last_access, (start, end)))
+                self._coalesce_ranges()
+    
+    def _coalesce_ranges(self):
+        """Объединить активные диапазоны, промежутки до RANGE_MERGE_GAP читаем целиком"""
+        merged = []
+        for start, end in sorted(self.active_ranges):
+            if merged and start - merged[-1][1] - 1 <= RANGE_MERGE_GAP:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.polling_ranges = [(start, end) for start, end in merged]
     
-    def get_polling_range(self):
-        """Получить текущий диапазон для polling (самый широкий)"""
+    def get_polling_ranges(self):
+        """Получить диапазоны для polling"""
         with self.ranges_lock:
-            current_time = time.time()
-            
-            # Удалить устаревшие диапазоны
-            to_remove = []
-            for range_key, last_access in self.active_ranges.items():
-                if current_time - last_access > RANGE_TIMEOUT:
-                    to_remove.append(range_key)
+            expire_before = time.time() - RANGE_TIMEOUT
             
-            for key in to_remove:
-                del self.active_ranges[key]
-                self.log(f"Range {key} removed (timeout)")
-            
-            if not self.active_ranges:
-                return None
+            # Удалить устаревшие диапазоны: проверяем только голову кучи
+            removed = False
+            while self.ranges_heap and self.ranges_heap[0][0] < expire_before:
+                last_access, key = heapq.heappop(self.ranges_heap)
+                latest_access = self.active_ranges.get(key)
+                
+                if latest_access == last_access:
+                    del self.active_ranges[key]
+                    removed = True
+                    self.log(f"Range {key} removed (timeout)")
+                elif latest_access is not None:
+                    # Диапазон запрашивали позже - вернуть в кучу с новым временем
+                    heapq.heappush(self.ranges_heap, (latest_access, key))
             
-            # Найти самый широкий диапазон
-            min_addr = min(start for start, end in self.active_ranges.keys())
-            max_addr = max(end for start, end in self.active_ranges.keys())
+            if removed:
+                self._coalesce_ranges()
             
-            return (min_addr, max_addr)
+            return self.polling_ranges
     
     def get_cached_registers(self, start, quantity):
         """Получить данные из кэша"""
         with self.cache_lock:
-            registers = []
-            for i in range(quantity):
-                addr = start + i
-                registers.append(self.register_cache.get(addr, 0))
-            return registers
+            return self.register_cache[start:start + quantity].tolist()
     
     def update_cache(self, start, registers):
         """Обновить кэш данных"""
+        end = start + len(registers)
         with self.cache_lock:
-            for i, value in enumerate(registers):
-                self.register_cache[start + i] = value
+            self.register_cache[start:end] = array('H', registers)
+            self.cached_count += self.cached_mask.count(0, start, end)
+            self.cached_mask[start:end] = b'\x01' * (end - start)
 
 client = ModbusClient()
 
-# ===== CRC CALCULATION =====
-def calculate_crc16(data):
-    """Calculate CRC16 for Modbus RTU"""
-    crc = 0xFFFF
-    
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    
-    return struct.pack('<H', crc)
-
 # ===== MODBUS FUNCTIONS =====
-def create_modbus_read_request(slave_address, register_address, quantity=1):
-    """Create Modbus RTU read request (function 0x03)"""
-    pdu = struct.pack('>BHH', 
-                      0x03,
-                      register_address,
-                      quantity)
+def send_modbus_request_raw(slave_address, register_address, quantity=None, write_value=None, write_values=None):
+    """Отправить Modbus запрос к железу (используется только фоновым потоком)"""
+    if not client.is_connected():
+        if not client.open_port():
+            return {
+                'status': 'error',
+                'message': 'Cannot open serial port'
+            }
     
-    request = bytes([slave_address]) + pdu
-    crc = calculate_crc16(request)
-    request += crc
+    try:
+        if write_values is not None:
+            request_data = create_modbus_write_multiple_request(slave_address, register_address, write_values)
+            operation = 'WRITE'
+        elif write_value is not None:
+            request_data = create_modbus_write_request(slave_address, register_address, write_value)
+            operation = 'WRITE'
+        else:
+            # Polling повторяет одни и те же кадры - собираем каждый один раз
+            cache_key = (slave_address, register_address, quantity)
+            request_data = client.request_cache.get(cache_key)
+            if request_data is None:
+                if len(client.request_cache) >= REQUEST_CACHE_SIZE:
+                    client.request_cache.clear()
+                request_data = create_modbus_read_request(slave_address, register_address, quantity)
+                client.request_cache[cache_key] = request_data
+            operation = 'READ'
+        
+        start_time = time.time()
+        response = send_modbus_request(client.port, request_data)
+        response_time = time.time() - start_time
+        
+        client.record_packet_time(response_time)
+        
+        parsed = parse_modbus_response(response)
+        
+        if parsed['status'] == 'success':
+            client.status = 'online'
+        else:
+            client.status = 'mb-offline'
+            client.add_error_log(f"Modbus error response: {parsed.get('message', parsed['raw'])}")
+        
+        return parsed
+        
+    except serial.SerialException as e:
+        client.status = 'mb-offline'
+        client.add_error_log(f"Serial exception: {str(e)}")
+        client.close_port()
+        return {'status': 'error', 'message': f'Serial error: {str(e)}'}
     
-    return request
+    except Exception as e:
+        client.status = 'mb-offline'
+        client.add_error_log(f"Unexpected error: {str(e)}")
+        return {'status': 'error', 'message': f'Error: {str(e)}'}
 
-def create_modbus_write_request(slave_address, register_address, value):
-    """Create Modbus RTU write single register request (function 0x06)"""
-    pdu = struct.pack('>BHH',
-                      0x06,
-                      register_address,
-                      value)
-    
-    request = bytes([slave_address]) + pdu
-    crc = calculate_crc16(request)
-    request += crc
+# ===== BACKGROUND WORKER =====
+def wait_for_task(duration):
+    """Пауза до duration секунд, прерывается, как только в очереди появилась задача"""
+    deadline = time.perf_counter() + duration
     
-    return request
+    while client.task_queue.empty():
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, TASK_WAIT_SLICE))
 
-def parse_modbus_response(response):
-    """Parse Modbus RTU response"""
-    if len(response) < 3:
-        return {
-            'status': 'error',
-            'message': 'Response too short',
-            'raw': response.hex()
-        }
+def poll_registers(start_addr, end_addr):
+    """Прочитать диапазон регистров в кэш частями по MAX_READ_QUANTITY.
     
-    result = {
-        'status': 'success',
-        'raw': response.hex(),
-        'slave_address': response[0],
-        'function_code': response[1],
-        'registers': []
-    }
+    Возвращает False, если polling прерван ради задач записи в очереди.
+    """
+    current_addr = start_addr
+    remaining = end_addr - start_addr + 1
+    
+    while remaining > 0:
+        # Запись пользователя не ждёт окончания всего цикла polling
+        if not client.task_queue.empty():
+            return False
+        
+        read_qty = min(remaining, MAX_READ_QUANTITY)
+        
+        result = send_modbus_request_raw(
+            SLAVE_ADDRESS,
+            current_addr,
+            quantity=read_qty
+        )
+        
+        if result['status'] != 'success':
+            client.add_error_log(f"Polling failed: addr={current_addr}, qty={read_qty}")
+        elif len(result['registers']) != read_qty:
+            # Лишние регистры раздули бы кэш за пределы REGISTER_SPACE
+            client.add_error_log(f"Wrong registers count in response: addr={current_addr}, {result['raw']}")
+        else:
+            client.update_cache(current_addr, result['registers'])
+        
+        current_addr += read_qty
+        remaining -= read_qty
+        wait_for_task(POLLING_INTERVAL)
     
-    if response[1] & 0x80:
-        result['status'] = 'error'
-        result['exception_code'] = response[2] if len(response) > 2 else None
-        return result
+    return True
+
+def collect_write_runs(first_task):
+    """Забрать из очереди накопившиеся записи и сгруппировать их в непрерывные блоки.
     
-    if response[1] == 0x03:
-        byte_count = response[2]
-        data = response[3:3 + byte_count]
-        
-        for i in range(0, len(data), 2):
-            if i + 1 < len(data):
-                register_value = (data[i] << 8) | data[i + 1]
-                result['registers'].append(register_value)
+    Возвращает список (start_addr, [values]) в порядке очереди. В блок объединяются
+    только записи, идущие подряд по соседним адресам; ни одна запись не теряется,
+    поэтому повторная запись в адрес (например, импульс 1 -> 0) уходит отдельно.
+    """
+    tasks = [first_task]
+    try:
+        while len(tasks) < WRITE_BURST_SIZE:
+            tasks.append(client.task_queue.get_nowait())
+    except Empty:
+        pass
     
-    elif response[1] == 0x06:
-        result['registers'].append((response[2] << 8) | response[3])
+    runs = []
+    for task in tasks:
+        if task['type'] != 'write':
+            continue
+        
+        addr = task['address']
+        if runs and runs[-1][0] + len(runs[-1][1]) == addr and len(runs[-1][1]) < MAX_WRITE_QUANTITY:
+            runs[-1][1].append(task['value'])
+        else:
+            runs.append((addr, [task['value']]))
     
-    return result
+    return runs
 
-def send_modbus_request_raw(slave_address, register_address, quantity=None, write_value=None):
-    """Отправить Modbus запрос к железу (используется только фоновым потоком)"""
-    with client.lock:
-        if not client.is_connected():
-            if not client.open_port():
-                return {
-                    'status': 'error',
-                    'message': 'Cannot open serial port'
-                }
+def write_registers(start_addr, values):
+    """Записать непрерывный блок регистров: 0x06 для одного, 0x10 для нескольких"""
+    if len(values) > 1 and client.write_multiple_supported:
+        result = send_modbus_request_raw(SLAVE_ADDRESS, start_addr, write_values=values)
         
-        try:
-            if write_value is not None:
-                request_data = create_modbus_write_request(slave_address, register_address, write_value)
-                operation = 'WRITE'
-            else:
-                request_data = create_modbus_read_request(slave_address, register_address, quantity)
-                operation = 'READ'
-            
-            start_time = time.time()
-            client.port.write(request_data)
-            time.sleep(0.05)
-            
-            response = client.port.read(256)
-            response_time = time.time() - start_time
-            
-            client.record_packet_time(response_time)
-            
-            parsed = parse_modbus_response(response)
-            
-            if parsed['status'] == 'success':
-                client.status = 'online'
-            else:
-                client.status = 'mb-offline'
-                client.add_error_log(f"Modbus error response: {parsed.get('message')}")
-            
-            return parsed
-            
-        except serial.SerialException as e:
-            client.status = 'mb-offline'
-            client.add_error_log(f"Serial exception: {str(e)}")
-            client.close_port()
-            return {'status': 'error', 'message': f'Serial error: {str(e)}'}
+        if result['status'] == 'success':
+            client.log(f"Write success: addr={start_addr}, values={values}")
+            return
         
-        except Exception as e:
-            client.status = 'mb-offline'
-            client.add_error_log(f"Unexpected error: {str(e)}")
-            return {'status': 'error', 'message': f'Error: {str(e)}'}
+        if result.get('exception_code') != ILLEGAL_FUNCTION:
+            client.add_error_log(f"Write failed: addr={start_addr}, {result.get('message', result.get('raw'))}")
+            return
+        
+        # Устройство не поддерживает 0x10 - дальше пишем по одному регистру
+        client.write_multiple_supported = False
+        client.add_error_log("Slave does not support function 0x10, falling back to 0x06")
+    
+    for offset, value in enumerate(values):
+        addr = start_addr + offset
+        result = send_modbus_request_raw(SLAVE_ADDRESS, addr, write_value=value)
+        
+        if result['status'] == 'success':
+            client.log(f"Write success: addr={addr}, value={value}")
+        else:
+            client.add_error_log(f"Write failed: addr={addr}, {result.get('message', result.get('raw'))}")
 
-# ===== BACKGROUND WORKER =====
 def background_worker():
     """Фоновый поток для обработки Modbus запросов"""
     client.log("Background worker started")
@@ -283,57 +374,22 @@ def background_worker():
             try:
                 task = client.task_queue.get(timeout=0.1)
                 
-                if task['type'] == 'write':
-                    # Задача на запись
-                    addr = task['address']
-                    value = task['value']
-                    
-                    result = send_modbus_request_raw(
-                        SLAVE_ADDRESS,
-                        addr,
-                        write_value=value
-                    )
-                    
-                    if result['status'] == 'success':
-                        client.log(f"Write success: addr={addr}, value={value}")
-                    else:
-                        client.add_error_log(f"Write failed: addr={addr}, {result.get('message')}")
-                
-                client.task_queue.task_done()
-                time.sleep(POLLING_INTERVAL)
+                # Задачи на запись - соседние адреса уходят одним кадром,
+                # вся пачка отправляется подряд без пауз
+                for start_addr, values in collect_write_runs(task):
+                    write_registers(start_addr, values)
                 
             except Empty:
                 # Очередь пуста - делаем polling регистров
-                polling_range = client.get_polling_range()
+                polling_ranges = client.get_polling_ranges()
                 
-                if polling_range:
-                    start_addr, end_addr = polling_range
-                    total_quantity = end_addr - start_addr + 1
-                    
-                    # Разбиваем на части по MAX_READ_QUANTITY
-                    current_addr = start_addr
-                    remaining = total_quantity
-                    
-                    while remaining > 0:
-                        read_qty = min(remaining, MAX_READ_QUANTITY)
-                        
-                        result = send_modbus_request_raw(
-                            SLAVE_ADDRESS,
-                            current_addr,
-                            quantity=read_qty
-                        )
-                        
-                        if result['status'] == 'success':
-                            client.update_cache(current_addr, result['registers'])
-                        else:
-                            client.add_error_log(f"Polling failed: addr={current_addr}, qty={read_qty}")
-                        
-                        current_addr += read_qty
-                        remaining -= read_qty
-                        time.sleep(POLLING_INTERVAL)
+                if polling_ranges:
+                    for start_addr, end_addr in polling_ranges:
+                        if not poll_registers(start_addr, end_addr):
+                            break
                 else:
-                    # Нет активных диапазонов - ждём
-                    time.sleep(0.5)
+                    # Нет активных диапазонов - ждём, но запись не задерживаем
+                    wait_for_task(0.5)
         
         except Exception as e:
             client.add_error_log(f"Worker error: {str(e)}")
@@ -363,6 +419,12 @@ def get_data():
                 'message': 'Invalid quantity'
             }), 400
         
+        if address < 0 or address + quantity > REGISTER_SPACE:
+            return jsonify({
+                'status': 'error',
+                'message': 'Invalid address'
+            }), 400
+        
         # Обновить активный диапазон
         client.update_active_range(address, address + quantity - 1)
         
@@ -398,6 +460,12 @@ def send_data():
         address = int(data['address'])
         value = int(data['value'])
         
+        if address < 0 or address >= REGISTER_SPACE:
+            return jsonify({
+                'status': 'error',
+                'message': 'Invalid address'
+            }), 400
+        
         if value < 0 or value > 65535:
             return jsonify({
                 'status': 'error',
@@ -429,22 +497,24 @@ def send_data():
 @app.route('/status', methods=['GET'])
 def status():
     """Получить статус (без обращения к порту)"""
-    polling_range = client.get_polling_range()
+    polling_ranges = client.get_polling_ranges()
+    
+    error_logs = client.error_logs_snapshot
     
-    return jsonify({
+    return app.response_class(orjson.dumps({
         'status': 'success',
         'modbus_status': client.status,
         'connection_state': 'connected' if client.is_connected() else 'disconnected',
         'avg_response_time_ms': round(client.get_avg_response_time() * 1000, 2),
         'last_10_packets_count': len(client.last_packets),
-        'error_logs': list(client.error_logs),
-        'error_log_count': len(client.error_logs),
-        'polling_range': f"{polling_range[0]}-{polling_range[1]}" if polling_range else "none",
+        'error_logs': error_logs,
+        'error_log_count': len(error_logs),
+        'polling_range': ", ".join(f"{start}-{end}" for start, end in polling_ranges) or "none",
         'active_ranges_count': len(client.active_ranges),
         'queue_size': client.task_queue.qsize(),
-        'cache_size': len(client.register_cache),
-        'timestamp': datetime.now().isoformat()
-    }), 200
+        'cache_size': client.cached_count,
+        'timestamp': _now_str()
+    }), status=200, mimetype='application/json')
 
 # ===== STARTUP/SHUTDOWN =====
 def start_background_worker():
@@ -473,7 +543,7 @@ if __name__ == "__main__":
     start_background_worker()
     
     try:
-        app.run(host='0.0.0.0', port=8082, debug=False, threaded=True)
+        serve(app, host='0.0.0.0', port=8082, threads=4, connection_limit=100)
     except KeyboardInterrupt:
         client.log("Shutdown signal received", 'INFO')
     finally:
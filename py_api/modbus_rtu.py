@@ -0,0 +1,155 @@
+import struct
+import time
+
+# ===== CRC CALCULATION =====
+def _build_crc16_table():
+    """Precompute CRC16 (poly 0xA001) for every byte value"""
+    table = []
+    
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    
+    return table
+
+CRC16_TABLE = _build_crc16_table()
+CRC_STRUCT = struct.Struct('<H')
+
+def calculate_crc16(data):
+    """Calculate CRC16 for Modbus RTU"""
+    crc = 0xFFFF
+    
+    for b in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ b) & 0xFF]
+    
+    return CRC_STRUCT.pack(crc)
+
+# ===== REQUESTS =====
+# slave address, function code, register address, quantity/value
+REQUEST_STRUCT = struct.Struct('>BBHH')
+
+def create_modbus_read_request(slave_address, register_address, quantity=1):
+    """Create Modbus RTU read request (function 0x03)"""
+    request = REQUEST_STRUCT.pack(slave_address, 0x03, register_address, quantity)
+    return request + calculate_crc16(request)
+
+def create_modbus_write_request(slave_address, register_address, value):
+    """Create Modbus RTU write single register request (function 0x06)"""
+    request = REQUEST_STRUCT.pack(slave_address, 0x06, register_address, value)
+    return request + calculate_crc16(request)
+
+def create_modbus_write_multiple_request(slave_address, register_address, values):
+    """Create Modbus RTU write multiple registers request (function 0x10)"""
+    count = len(values)
+    request = struct.pack(f'>BBHHB{count}H',
+                          slave_address,
+                          0x10,
+                          register_address,
+                          count,
+                          2 * count,
+                          *values)
+    return request + calculate_crc16(request)
+
+def create_modbus_read_write_request(slave_address, read_address, read_quantity, write_address, values):
+    """Create Modbus RTU read/write multiple registers request (function 0x17)"""
+    count = len(values)
+    request = struct.pack(f'>BBHHHHB{count}H',
+                          slave_address,
+                          0x17,
+                          read_address,
+                          read_quantity,
+                          write_address,
+                          count,
+                          2 * count,
+                          *values)
+    return request + calculate_crc16(request)
+
+# ===== RESPONSES =====
+def parse_modbus_response(response):
+    """Parse Modbus RTU response"""
+    if len(response) < 5:
+        return {
+            'status': 'error',
+            'message': 'Response too short',
+            'raw': response.hex()
+        }
+    
+    # Битый кадр не должен попасть в кэш регистров
+    if calculate_crc16(response[:-2]) != response[-2:]:
+        return {
+            'status': 'error',
+            'message': 'CRC mismatch',
+            'raw': response.hex()
+        }
+    
+    result = {
+        'status': 'success',
+        'raw': response.hex(),
+        'slave_address': response[0],
+        'function_code': response[1],
+        'registers': []
+    }
+    
+    if response[1] & 0x80:
+        result['status'] = 'error'
+        result['exception_code'] = response[2] if len(response) > 2 else None
+        return result
+    
+    if response[1] in (0x03, 0x17):
+        byte_count = min(response[2], len(response) - 3)
+        
+        # Все регистры одним вызовом struct (big-endian uint16)
+        result['registers'] = list(struct.unpack_from(f'>{byte_count // 2}H', response, 3))
+    
+    elif response[1] == 0x06:
+        result['registers'].append((response[2] << 8) | response[3])
+    
+    return result
+
+def read_modbus_response(port):
+    """Read one Modbus RTU response frame, length is taken from its header"""
+    # slave address + function code + byte count / exception code
+    header = port.read(3)
+    if len(header) < 3:
+        return header
+    
+    function_code = header[1]
+    if function_code & 0x80:
+        remaining = 2  # CRC
+    elif function_code in (0x03, 0x17):
+        remaining = header[2] + 2  # data + CRC
+    else:
+        remaining = 5  # rest of address/value echo + CRC
+    
+    return header + port.read(remaining)
+
+# ===== TRANSACTION =====
+# Момент окончания последнего ответа по каждому порту (time.perf_counter)
+_last_frame_end = {}
+
+def frame_gap(baudrate):
+    """Silent interval between frames: 3.5 characters, fixed 1.75 ms above 19200 baud"""
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * 11 / baudrate
+
+def send_modbus_request(port, request):
+    """Send request to the port and read one response frame"""
+    # Кадры подряд (запись + чтение) должны разделяться паузой 3.5 символа
+    wait = _last_frame_end.get(port, 0) + frame_gap(port.baudrate) - time.perf_counter()
+    if wait > 0:
+        time.sleep(wait)
+    
+    # Отбросить опоздавшие байты прошлого ответа, иначе кадры сместятся
+    port.reset_input_buffer()
+    port.write(request)
+    
+    # Читаем ровно один кадр - без фиксированной паузы
+    response = read_modbus_response(port)
+    _last_frame_end[port] = time.perf_counter()
+    return response